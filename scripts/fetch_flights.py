@@ -2,9 +2,12 @@ import os
 import json
 import requests
 import csv
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from time import sleep
-from typing import Dict, Optional, List
+from time import sleep, time
+from typing import Dict, Optional, List, Tuple
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -13,11 +16,38 @@ load_dotenv()
 API_KEY        = os.getenv("API_KEY")
 HEADERS        = {"x-api-key": API_KEY, "Content-Type": "application/json"}
 INDICATIVE_URL = "https://partners.api.skyscanner.net/apiservices/v3/flights/indicative/search"
+LIVE_CREATE_URL = "https://partners.api.skyscanner.net/apiservices/v3/flights/live/search/create"
+LIVE_POLL_URL   = "https://partners.api.skyscanner.net/apiservices/v3/flights/live/search/poll/{token}"
 
 INPUT_JSON   = "../data/ranked_cities_top20.json"
 USER_JSON    = "../data/user_info.json"
 OUTPUT_JSON  = "../data/final_scored.json"
 AIRPORTS_CSV = "../data/iata_airports_and_locations_with_vibes.csv"
+CACHE_DB     = "../data/api_cache.db"
+
+# Tier 1: cheap indicative sweep over every candidate
+INDICATIVE_WORKERS   = 8
+INDICATIVE_TTL_HOURS = 6
+# Tier 2: detailed live itineraries, only for the final top-N
+DETAILED_TOP_N       = 5
+DETAILED_WORKERS     = 4
+DETAILED_TTL_HOURS   = 1
+LIVE_MAX_POLLS       = 15
+LIVE_POLL_INTERVAL   = 2.0
+
+# Retries for rate-limited (429) / server-side (5xx) / network failures
+MAX_RETRIES          = 4
+RETRY_BACKOFF        = 1.0
+
+# Live search prices are integers scaled by their "unit"
+PRICE_UNIT_DIVISORS = {
+    "PRICE_UNIT_WHOLE": 1.0,
+    "PRICE_UNIT_CENTI": 100.0,
+    "PRICE_UNIT_MILLI": 1000.0,
+}
+
+ITINERARY_FIELDS = ["airline", "origin_airport", "destination_airport",
+                    "departure_time", "arrival_time", "duration_minutes"]
 
 # ── Helpers ───────────────────────────────────────────────────────────────────
 
@@ -36,13 +66,83 @@ def load_airport_mapping(csv_path: str) -> Dict[str, str]:
     return mapping
 
 
+class ResponseCache:
+    """
+    Tiny SQLite cache of raw API responses, one table per pricing tier.
+    Shared by the worker threads, so every access goes through a lock.
+    """
+    def __init__(self, path: str, tables: List[str]):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            for table in tables:
+                self.conn.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table} "
+                    "(key TEXT PRIMARY KEY, response TEXT, fetched_at REAL)")
+
+    def get(self, table: str, key: str, ttl_hours: float) -> Optional[Dict]:
+        with self.lock:
+            row = self.conn.execute(
+                f"SELECT response, fetched_at FROM {table} WHERE key = ?", (key,)
+            ).fetchone()
+        if not row or time() - row[1] > ttl_hours * 3600:
+            return None
+        return json.loads(row[0])
+
+    def put(self, table: str, key: str, response: Dict) -> None:
+        with self.lock, self.conn:
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO {table} VALUES (?, ?, ?)",
+                (key, json.dumps(response), time()))
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def cache_key(origin: str, dest: str,
+              dep_date: Optional[datetime.date] = None,
+              ret_date: Optional[datetime.date] = None) -> str:
+    return f"{origin}|{dest}|{dep_date or 'anytime'}|{ret_date or 'anytime'}"
+
+
+def post_json(url: str, label: str, payload: Optional[Dict] = None,
+              timeout: int = 10) -> Optional[Dict]:
+    """
+    POST to the partner API, retrying 429/5xx and network errors with
+    exponential backoff. Returns the decoded body, or None if the call failed
+    (so callers can tell an error apart from a successful empty result).
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            r = requests.post(url, headers=HEADERS, json=payload, timeout=timeout)
+        except requests.exceptions.RequestException as e:
+            error = f"Request error for {label}: {e}"
+        else:
+            if r.status_code == 200:
+                return r.json()
+            error = f"Error {r.status_code} for {label}: {r.text}"
+            if r.status_code != 429 and r.status_code < 500:
+                print(error)
+                return None
+        if attempt < MAX_RETRIES:
+            sleep(RETRY_BACKOFF * 2 ** attempt)
+    print(f"{error} (gave up after {MAX_RETRIES} retries)")
+    return None
+
+
 def extract_quotes(resp: Dict) -> Dict:
     return (resp or {}).get("content", {}).get("results", {}).get("quotes", {}) or {}
 
 def get_indicative(origin: str, dest: str,
                    dep_date: Optional[datetime.date] = None,
-                   ret_date: Optional[datetime.date] = None) -> Dict:
-    print(f"DATES: {dep_date} {ret_date}")
+                   ret_date: Optional[datetime.date] = None,
+                   cache: Optional[ResponseCache] = None) -> Optional[Dict]:
+    key = cache_key(origin, dest, dep_date, ret_date)
+    if cache:
+        cached = cache.get("indicative", key, INDICATIVE_TTL_HOURS)
+        if cached is not None:
+            return cached
+
     legs = [{
         "originPlace": {"queryPlace": {"iata": origin}},
         "destinationPlace": {"queryPlace": {"iata": dest}}
@@ -63,12 +163,37 @@ def get_indicative(origin: str, dest: str,
         "currency": "EUR",
         "queryLegs": legs
     }}
-    r = requests.post(INDICATIVE_URL, headers=HEADERS, json=payload, timeout=10)
-    if r.status_code != 200:
-        print(f"Error {r.status_code} for {origin}->{dest}: {r.text}")
-        return {}
-    print(f"dates: {dep_date} - {ret_date} | {origin}->{dest} | {r.status_code}")
-    return r.json()
+    data = post_json(INDICATIVE_URL, f"{origin}->{dest}", payload)
+    if data is None:
+        return None
+    print(f"dates: {dep_date} - {ret_date} | {origin}->{dest} | OK")
+    if cache:
+        cache.put("indicative", key, data)
+    return data
+
+def fetch_indicative_price(origin: str, dest: str,
+                           dep_date: datetime.date, ret_date: datetime.date,
+                           cache: ResponseCache) -> Tuple[Optional[float], bool]:
+    """
+    Cheapest indicative price for one origin→dest pair: the fixed dates first,
+    falling back to 'anytime' only when the dated search succeeded but had
+    no quotes. Returns (price, used_anytime); price is None on failure.
+    """
+    data = get_indicative(origin, dest, dep_date, ret_date, cache)
+    if data is None:
+        return None, False
+    quotes = extract_quotes(data)
+    used_any = False
+    if not quotes:
+        data = get_indicative(origin, dest, cache=cache)
+        if data is None:
+            return None, True
+        quotes = extract_quotes(data)
+        used_any = True
+    q, price = pick_cheapest(quotes)
+    if not q:
+        return None, used_any
+    return price, used_any
 
 def pick_cheapest(quotes: Dict) -> (Optional[Dict], Optional[float]):
     best, best_price = None, float('inf')
@@ -83,6 +208,118 @@ def pick_cheapest(quotes: Dict) -> (Optional[Dict], Optional[float]):
             continue
     return best, best_price if best is not None else (None, None)
 
+def get_live_itineraries(origin: str, dest: str,
+                         dep_date: datetime.date, ret_date: datetime.date,
+                         cache: ResponseCache) -> Dict:
+    """
+    Detailed (live) search for a dated return trip. Much slower than the
+    indicative endpoint: create a session, then poll until it completes.
+    """
+    key = cache_key(origin, dest, dep_date, ret_date)
+    cached = cache.get("itinerary", key, DETAILED_TTL_HOURS)
+    if cached is not None:
+        return cached
+
+    def leg(frm: str, to: str, d: datetime.date) -> Dict:
+        return {
+            "originPlaceId":      {"iata": frm},
+            "destinationPlaceId": {"iata": to},
+            "date": {"year": d.year, "month": d.month, "day": d.day}
+        }
+
+    payload = {"query": {
+        "market":     "ES",
+        "locale":     "en-GB",
+        "currency":   "EUR",
+        "queryLegs":  [leg(origin, dest, dep_date), leg(dest, origin, ret_date)],
+        "adults":     1,
+        "cabinClass": "CABIN_CLASS_ECONOMY"
+    }}
+    label = f"live {origin}->{dest}"
+    data = post_json(LIVE_CREATE_URL, label, payload, timeout=20)
+    if data is None:
+        return {}
+    for _ in range(LIVE_MAX_POLLS):
+        if data.get("status") != "RESULT_STATUS_INCOMPLETE":
+            break
+        sleep(LIVE_POLL_INTERVAL)
+        polled = post_json(LIVE_POLL_URL.format(token=data["sessionToken"]), label, timeout=20)
+        if polled is None:
+            break
+        data = polled
+
+    status = data.get("status")
+    print(f"live: {dep_date} - {ret_date} | {origin}->{dest} | {status}")
+    if status == "RESULT_STATUS_COMPLETE":
+        cache.put("itinerary", key, data)
+    elif status == "RESULT_STATUS_INCOMPLETE":
+        print(f"  ⚠️  Live search for {origin}->{dest} still incomplete, not caching partial results")
+    return data
+
+def format_datetime(dt: Optional[Dict]) -> Optional[str]:
+    if not dt:
+        return None
+    try:
+        return datetime(dt["year"], dt["month"], dt["day"],
+                        dt.get("hour", 0), dt.get("minute", 0)).isoformat(timespec="minutes")
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def describe_leg(leg: Optional[Dict], places: Dict, carriers: Dict) -> Dict:
+    if not leg:
+        return {f: None for f in ITINERARY_FIELDS}
+    carrier_ids = leg.get("marketingCarrierIds") or leg.get("operatingCarrierIds") or []
+    airline = carriers.get(carrier_ids[0], {}).get("name") if carrier_ids else None
+    return {
+        "airline":             airline,
+        "origin_airport":      places.get(leg.get("originPlaceId"), {}).get("iata"),
+        "destination_airport": places.get(leg.get("destinationPlaceId"), {}).get("iata"),
+        "departure_time":      format_datetime(leg.get("departureDateTime")),
+        "arrival_time":        format_datetime(leg.get("arrivalDateTime")),
+        "duration_minutes":    leg.get("durationInMinutes"),
+    }
+
+def empty_itinerary() -> Dict:
+    detail = {f"{side}_{f}": None for side in ("outbound", "return") for f in ITINERARY_FIELDS}
+    detail["detailed_price_eur"] = None
+    return detail
+
+def pick_itinerary(resp: Dict) -> Optional[Dict]:
+    """
+    Flatten the cheapest live itinerary into the outbound_* / return_* fields
+    used by enriched_routes.json, plus its bookable price.
+    """
+    content = (resp or {}).get("content", {})
+    results = content.get("results", {})
+    itineraries = results.get("itineraries") or {}
+    if not itineraries:
+        return None
+
+    cheapest = content.get("sortingOptions", {}).get("cheapest") or []
+    it_id = cheapest[0]["itineraryId"] if cheapest else next(iter(itineraries))
+    itinerary = itineraries.get(it_id, {})
+
+    legs, places, carriers = results.get("legs", {}), results.get("places", {}), results.get("carriers", {})
+    leg_ids = itinerary.get("legIds", [])
+    out = describe_leg(legs.get(leg_ids[0]) if leg_ids else None, places, carriers)
+    ret = describe_leg(legs.get(leg_ids[1]) if len(leg_ids) > 1 else None, places, carriers)
+
+    detail = {f"outbound_{k}": v for k, v in out.items()}
+    detail.update({f"return_{k}": v for k, v in ret.items()})
+
+    price = None
+    for option in itinerary.get("pricingOptions", []):
+        try:
+            amount = float(option["price"]["amount"])
+            divisor = PRICE_UNIT_DIVISORS[option["price"].get("unit", "PRICE_UNIT_MILLI")]
+        except (KeyError, TypeError, ValueError):
+            continue
+        p = amount / divisor
+        if price is None or p < price:
+            price = p
+    detail["detailed_price_eur"] = round(price, 2) if price is not None else None
+    return detail
+
 def normalize_list(vals: List[float]) -> List[float]:
     if not vals:
         return []
@@ -113,7 +350,14 @@ def main():
             iata = "MAD"
         t["origin_iata"] = iata
 
-    # 4) Fetch flight prices for each destination & each traveler
+    # 4) Tier 1: indicative prices for every (origin, destination) pair, concurrently
+    cache = ResponseCache(CACHE_DB, ["indicative", "itinerary"])
+    pairs = {(t["origin_iata"], d["iata"]) for d in destinations for t in travelers}
+    with ThreadPoolExecutor(max_workers=INDICATIVE_WORKERS) as pool:
+        futures = {pair: pool.submit(fetch_indicative_price, *pair, dep, ret, cache)
+                   for pair in pairs}
+        indicative = {pair: f.result() for pair, f in futures.items()}
+
     enriched = []
     for dest in destinations:
         dest_iata = dest["iata"]
@@ -122,20 +366,8 @@ def main():
 
         for t in travelers:
             org = t["origin_iata"]
-            # first try specific dates
-            print(f"DATES PRE CALL: {dep} {ret}")
-            data = get_indicative(org, dest_iata, dep, ret)
-            quotes = extract_quotes(data)
-            used_any = False
-
-            if not quotes:
-                # fallback anytime
-                data = get_indicative(org, dest_iata)
-                quotes = extract_quotes(data)
-                used_any = True
-
-            q, price = pick_cheapest(quotes)
-            if not q:
+            price, used_any = indicative[(org, dest_iata)]
+            if price is None:
                 print(f"  ⚠️  No quote for traveler {t['travelerNumber']} on {org}->{dest_iata}")
                 traveler_prices = []
                 break
@@ -145,7 +377,6 @@ def main():
                 warnings.append(f"Traveler {t['travelerNumber']} used anytime (x2)")
 
             traveler_prices.append(price)
-            sleep(0.2)
 
         # require every traveler to have a price
         if len(traveler_prices) != len(travelers):
@@ -187,6 +418,27 @@ def main():
     for idx, d in enumerate(enriched, 1):
         d["final_rank"] = idx
 
+    # 7) Tier 2: detailed itineraries, only for the finalists
+    finalists = enriched[:DETAILED_TOP_N]
+    pairs = {(t["origin_iata"], d["iata"]) for d in finalists for t in travelers}
+    with ThreadPoolExecutor(max_workers=DETAILED_WORKERS) as pool:
+        futures = {pair: pool.submit(get_live_itineraries, *pair, dep, ret, cache)
+                   for pair in pairs}
+        detailed = {pair: pick_itinerary(f.result()) for pair, f in futures.items()}
+    cache.close()
+
+    # one entry per traveler, aligned with traveler_prices
+    for d in finalists:
+        itineraries = []
+        for t in travelers:
+            detail = detailed.get((t["origin_iata"], d["iata"]))
+            if not detail:
+                detail = empty_itinerary()
+                d.setdefault("warnings", []).append(
+                    f"Traveler {t['travelerNumber']} has no detailed itinerary")
+            itineraries.append({"travelerNumber": t["travelerNumber"], **detail})
+        d["traveler_itineraries"] = itineraries
+
     with open(OUTPUT_JSON, 'w', encoding='utf-8') as f:
         json.dump(enriched, f, indent=2, ensure_ascii=False)
 